@@ -0,0 +1,103 @@
+# Helpers shared by the media-vtt and publications-jwpub download scripts.
+
+import gzip
+import io
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import traceback
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MANIFEST_URL = "https://app.jw-cdn.org/catalogs/publications/v4/manifest.json"
+
+# Build a pooled requests.Session: connections to app.jw-cdn.org are kept
+# alive across calls, transient 429/5xx responses retry with backoff, and
+# gzip/brotli are negotiated for API responses
+def make_session(pool_maxsize=32, backoff_factor=1):
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=3, backoff_factor=backoff_factor,
+                          status_forcelist=[429, 500, 502, 503, 504])
+    ))
+    session.headers.update({'Accept-Encoding': 'gzip, br'})
+    return session
+
+# Apply the standard sqlite performance pragmas to a connection
+def tune_connection(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=1073741824")
+    conn.execute("PRAGMA busy_timeout=5000")
+
+# Return an in-memory sqlite connection to the publication catalog.
+# The decompressed catalog.db is cached in cache_dir together with the
+# manifest ID it came from; runs within cache_ttl seconds skip even the
+# manifest check, and older caches are reused as long as the manifest ID
+# (a content version) has not moved.
+def fetch_catalog_conn(session, cache_dir, cache_ttl=3600):
+    db_path = os.path.join(cache_dir, "catalog.db")
+    manifest_path = db_path + ".manifest"
+    try:
+        data = None
+        if os.path.exists(db_path) and time.time() - os.path.getmtime(db_path) < cache_ttl:
+            logging.info(f"Using cached catalog at {db_path}.")
+            with open(db_path, "rb") as cached:
+                data = cached.read()
+        else:
+            logging.info("Fetching manifest ID.")
+            response = session.get(MANIFEST_URL)
+            response.raise_for_status()
+            manifest_id = orjson.loads(response.content).get('current')
+            if not manifest_id:
+                logging.error("Failed to fetch manifest ID.")
+                raise ValueError("Manifest ID is missing")
+
+            stored_id = None
+            if os.path.exists(manifest_path) and os.path.exists(db_path):
+                with open(manifest_path, "r", encoding="utf-8") as sidecar:
+                    stored_id = sidecar.read().strip()
+
+            if stored_id == manifest_id:
+                logging.info(f"Catalog manifest {manifest_id} unchanged, reusing {db_path}.")
+                os.utime(db_path)  # refresh the ttl fast path
+                with open(db_path, "rb") as cached:
+                    data = cached.read()
+            else:
+                catalog_url = f"https://app.jw-cdn.org/catalogs/publications/v4/{manifest_id}/catalog.db.gz"
+                logging.info(f"Downloading catalog from {catalog_url}.")
+
+                # Gunzip straight off the socket in one pass; ask for the bytes
+                # as-is since they are already a .gz we decompress ourselves
+                buffer = io.BytesIO()
+                with session.get(catalog_url, stream=True, headers={'Accept-Encoding': 'identity'}) as response:
+                    response.raise_for_status()
+                    with gzip.GzipFile(fileobj=response.raw) as gz:
+                        shutil.copyfileobj(gz, buffer, length=1 << 20)
+                data = buffer.getvalue()
+
+                # Cache the decompressed catalog and its version for next run
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(db_path, "wb") as cached:
+                    cached.write(data)
+                with open(manifest_path, "w", encoding="utf-8") as sidecar:
+                    sidecar.write(manifest_id)
+
+        # Load the serialized database into memory; the catalog is read-only
+        # and the queries run entirely over memory-resident pages
+        conn = sqlite3.connect(":memory:")
+        conn.deserialize(data)
+        return conn
+    except Exception as e:
+        logging.error(f"Error in fetching or extracting catalog.db: {e}")
+        logging.debug(f"Exception details: {traceback.format_exc()}")
+        return None
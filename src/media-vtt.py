@@ -1,14 +1,16 @@
-import requests
+import aiohttp
+import asyncio
 import gzip
-import shutil
-import json
+import orjson
 import logging
 import os
+import random
 import sqlite3
 import traceback
-import time
 from urllib.parse import urlparse, unquote
 
+from jw_common import make_session, tune_connection
+
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -16,23 +18,36 @@ JW_LANG = os.environ.get('JW_LANG', 'S')  # Default to 'S' for Spanish
 JW_OUTPUT_PATH = os.environ.get('JW_OUTPUT_PATH', '/jworg/vtts/')  # Set to '/jworg/vtts/' as per your requirement
 JW_DB_PATH = os.environ.get('JW_DB_PATH', '/jworg/vtts/jw_media.db')  # Database in '/jworg/vtts/'
 
+# Write the status marks to disk once per this many rows instead of per row
+DB_MARK_BATCH_SIZE = 500
+
+# Number of concurrent download workers; the work is pure network I/O
+CONCURRENCY = 32
+
+# One pooled session for the (synchronous, streaming) catalog download;
+# transient errors retry with backoff
+SESSION = make_session(pool_maxsize=64, backoff_factor=1)
+
+# Single long-lived database connection, opened in setup_database()
+DB = None
+
+# In-memory mirror of downloaded_vtts, filled by load_vtt_status()
+VTT_STATUS = {}
+
+# Marks accumulate here and land in one executemany transaction per batch
+PENDING_MARKS = []
+
 # Create output directory if it doesn't exist
-if not os.path.exists(JW_OUTPUT_PATH):
-    os.makedirs(JW_OUTPUT_PATH)
+os.makedirs(JW_OUTPUT_PATH, exist_ok=True)
 
-# Ensure the database and table are created
+# Open the single shared connection and ensure the table is created
 def setup_database(db_path):
-    db_dir = os.path.dirname(db_path)
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir)
-    if not os.path.exists(db_path):
-        logging.info(f"Database does not exist at {db_path}. Creating new database.")
-        open(db_path, 'w').close()
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        tune_connection(conn)
         # Changed 'pubSymbol' to 'identifier'
-        cursor.execute('''CREATE TABLE IF NOT EXISTS downloaded_vtts (
+        conn.execute('''CREATE TABLE IF NOT EXISTS downloaded_vtts (
                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                                 identifier TEXT NOT NULL,
                                 track INTEGER NOT NULL,
@@ -41,218 +56,278 @@ def setup_database(db_path):
                                 status TEXT NOT NULL,
                                 UNIQUE(identifier, track, formatCode)
                               )''')
+        # Covering index so the status preload/lookup never touches the table heap
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_vtt_lookup
+                        ON downloaded_vtts(identifier, track, formatCode, status)''')
         conn.commit()
-        conn.close()
+        return conn
     except Exception as e:
         logging.error(f"Error setting up database: {e}")
+        return None
 
-# Check if a media item has been processed
-def is_vtt_processed(db_path, identifier, track, formatCode):
+# Load the status of every known media item in one query; per-item point
+# SELECTs would otherwise dominate the preflight check on large catalogs
+def load_vtt_status():
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT status FROM downloaded_vtts WHERE identifier = ? AND track = ? AND formatCode = ?",
-            (identifier, track, formatCode)
-        )
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            return result[0]
-        else:
-            return None
+        cursor = DB.execute("SELECT identifier, track, formatCode, status FROM downloaded_vtts")
+        VTT_STATUS.update({(identifier, track, formatCode): status
+                           for identifier, track, formatCode, status in cursor})
     except Exception as e:
-        logging.error(f"Error checking database for {identifier}, track {track}, format {formatCode}: {e}")
-        return None
-
-# Mark a media item as processed
-def mark_vtt_as_downloaded(db_path, identifier, track, formatCode, vtt_url, status):
+        logging.error(f"Error loading processed statuses from database: {e}")
+    return VTT_STATUS
+
+# Mark a media item as processed; rows are buffered and written in batches
+def mark_vtt_as_downloaded(identifier, track, formatCode, vtt_url, status):
+    PENDING_MARKS.append((identifier, track, formatCode, vtt_url, status))
+    VTT_STATUS[(identifier, track, formatCode)] = status
+    if len(PENDING_MARKS) >= DB_MARK_BATCH_SIZE:
+        flush_marks()
+
+# Write all buffered marks in one transaction (one fsync per batch)
+def flush_marks():
+    if not PENDING_MARKS:
+        return
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            '''INSERT OR REPLACE INTO downloaded_vtts (identifier, track, formatCode, vtt_url, status)
-               VALUES (?, ?, ?, ?, ?)''',
-            (identifier, track, formatCode, vtt_url, status)
-        )
-        conn.commit()
-        conn.close()
+        with DB:
+            DB.executemany(
+                '''INSERT OR REPLACE INTO downloaded_vtts (identifier, track, formatCode, vtt_url, status)
+                   VALUES (?, ?, ?, ?, ?)''',
+                PENDING_MARKS
+            )
     except Exception as e:
-        logging.error(f"Error inserting into database for {identifier} track {track} format {formatCode}: {e}")
+        logging.error(f"Error writing {len(PENDING_MARKS)} status marks to database: {e}")
+    PENDING_MARKS.clear()
 
-def download_extract_json(catalog_url, output_path):
+def iter_catalog_lines(catalog_url):
+    # Decompress the catalog straight off the socket instead of writing a
+    # .json.gz and a .json to disk and re-reading them
     try:
         logging.info(f"Downloading catalog from {catalog_url}.")
-        response = requests.get(catalog_url, stream=True)
-        response.raise_for_status()
-        
-        gz_path = os.path.join(output_path, f"{JW_LANG}.json.gz")
-        json_path = os.path.join(output_path, f"{JW_LANG}.json")
-
-        with open(gz_path, "wb") as gz_file:
-            gz_file.write(response.content)
-
-        logging.info("Extracting the JSON")
-
-        with gzip.open(gz_path, "rb") as f_in:
-            with open(json_path, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-
-        # Delete the .gz file after extraction
-        logging.info(f"Deleting {gz_path} after extraction.")
-        os.remove(gz_path)
-
-        return json_path
-
+        # The catalog is already a .gz we gunzip ourselves, so ask for the
+        # bytes as-is rather than a second transport encoding
+        with SESSION.get(catalog_url, stream=True, headers={'Accept-Encoding': 'identity'}) as response:
+            response.raise_for_status()
+            with gzip.GzipFile(fileobj=response.raw) as gz:
+                # Yield raw bytes lines; orjson parses bytes directly so we
+                # never pay for a UTF-8 decode into str
+                yield from gz
     except Exception as e:
         logging.error(f"Error in downloading or extracting JSON: {e}")
-        return None
 
-def extract_media_info(json_path):
-    media_info = []
+# Yields media items lazily so the catalog is never fully resident in memory
+def extract_media_info(catalog_lines):
+    seen = set()
     try:
-        with open(json_path, 'r', encoding='utf-8') as file:
-            for line in file:
-                item = json.loads(line)
-                if item['type'] == 'media-item':
-                    o = item.get('o', {})
-                    key_parts = o.get('keyParts', {})
-
-                    # Get 'identifier' as either 'pubSymbol' or 'docID'
-                    identifier = key_parts.get('pubSymbol') or key_parts.get('docID')
-                    track = key_parts.get('track')
-                    formatCode = key_parts.get('formatCode')
-
-                    if identifier and track is not None and formatCode:
-                        media_info.append((identifier, track, formatCode, key_parts))
+        for line in catalog_lines:
+            # Cheap C-speed substring check first; most catalog lines are not
+            # media items and never need a full JSON parse
+            if b'"media-item"' not in line:
+                continue
+            item = orjson.loads(line)
+            if item['type'] == 'media-item':
+                o = item.get('o', {})
+                key_parts = o.get('keyParts', {})
+
+                # Get 'identifier' as either 'pubSymbol' or 'docID'
+                identifier = key_parts.get('pubSymbol') or key_parts.get('docID')
+                track = key_parts.get('track')
+                formatCode = key_parts.get('formatCode')
+
+                if identifier and track is not None and formatCode:
+                    # The catalog can repeat the same key; download each once
+                    if (identifier, track, formatCode) in seen:
+                        continue
+                    seen.add((identifier, track, formatCode))
+                    yield (identifier, track, formatCode, key_parts)
     except Exception as e:
         logging.error(f"Error in extracting media info: {e}")
 
-    return media_info
+# Responses memoized per (pub/docid, track) for the run; different
+# formatCodes of the same publication share one API response
+_media_links_cache = {}
 
-def get_pub_media_links(identifier, track, formatCode, key_parts):
+async def get_pub_media_links(session, identifier, track, formatCode, key_parts):
     base_url = "https://app.jw-cdn.org/apis/pub-media/GETPUBMEDIALINKS"
 
     # Determine whether to use 'pub' or 'docid' parameter
     params = {
         'langwritten': JW_LANG,
-        'track': track,
+        'track': str(track),
         # 'fileformat' parameter is removed as per your instructions
     }
 
     if 'pubSymbol' in key_parts:
         params['pub'] = key_parts['pubSymbol']
     elif 'docID' in key_parts:
-        params['docid'] = key_parts['docID']
+        params['docid'] = str(key_parts['docID'])
     else:
         logging.error(f"No 'pubSymbol' or 'docID' found in key parts: {key_parts}")
         return None
 
+    cache_key = tuple(sorted(params.items()))
+    if cache_key in _media_links_cache:
+        return _media_links_cache[cache_key]
+
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.HTTPError as http_err:
+        async with session.get(base_url, params=params) as response:
+            response.raise_for_status()
+            media_links = orjson.loads(await response.read())
+        _media_links_cache[cache_key] = media_links
+        return media_links
+    except aiohttp.ClientResponseError as http_err:
         logging.error(f"HTTP error for {identifier} track {track} format {formatCode}: {http_err}")
         return None
     except Exception as e:
         logging.error(f"Error in accessing media links API: {e}")
         return None
 
-def download_vtt_files(media_info, max_retries=3):
-    for identifier, track, formatCode, key_parts in media_info:
-        status = is_vtt_processed(JW_DB_PATH, identifier, track, formatCode)
-
-        if status == 'success':
-            logging.info(f"Already successfully processed {identifier} track {track} format {formatCode}, skipping.")
-            continue
-        elif status == 'failed':
-            logging.info(f"Already attempted but failed {identifier} track {track} format {formatCode}, skipping.")
-            continue
-        else:
-            # Proceed to attempt to get media links and download
-            media_links = get_pub_media_links(identifier, track, formatCode, key_parts)
-
-            if media_links and "files" in media_links:
-                vtt_file_url = None
-
-                # We no longer skip items based on title
-                formats = media_links["files"].get(JW_LANG, {})
-
-                found_vtt = False
-                # Iterate over available formats and files
-                for file_format_entries in formats.values():
-                    for file in file_format_entries:
-                        # Check if 'subtitles' are available
-                        subtitles = file.get('subtitles')
-                        if subtitles and 'url' in subtitles:
-                            vtt_file_url = subtitles['url']
-                            found_vtt = True
-                            break
-                    if found_vtt:
-                        break
-
-                if vtt_file_url:
-                    retry_count = 0
-                    while retry_count < max_retries:
-                        try:
-                            vtt_response = requests.get(vtt_file_url, stream=True)
-                            vtt_response.raise_for_status()
-
-                            # Extract the filename from the URL
-                            parsed_url = urlparse(vtt_file_url)
-                            filename = os.path.basename(parsed_url.path)
-                            filename = unquote(filename)  # Decode URL-encoded characters
-
-                            # Save VTT file with the original filename
-                            vtt_filename = os.path.join(JW_OUTPUT_PATH, filename)
-
-                            with open(vtt_filename, 'wb') as vtt_output:
-                                vtt_output.write(vtt_response.content)
-
-                            logging.info(f"Downloaded: {vtt_filename}")
-
-                            # Mark the VTT as successfully downloaded
-                            mark_vtt_as_downloaded(JW_DB_PATH, identifier, track, formatCode, vtt_file_url, 'success')
-                            break  # Success, exit retry loop
-
-                        except requests.exceptions.RequestException as e:
-                            retry_count += 1
-                            logging.warning(f"Attempt {retry_count} failed for {identifier} track {track}: {e}")
-                            logging.debug(f"Exception details: {traceback.format_exc()}")
-                            if retry_count < max_retries:
-                                wait_time = 2 ** retry_count
-                                logging.info(f"Retrying in {wait_time} seconds...")
-                                time.sleep(wait_time)
-                            else:
-                                logging.error(f"All {max_retries} attempts failed for {identifier} track {track}")
-                                # Mark the VTT as failed
-                                mark_vtt_as_downloaded(JW_DB_PATH, identifier, track, formatCode, vtt_file_url, 'failed')
-                        except Exception as e:
-                            logging.error(f"Unexpected error for {identifier} track {track}: {e}")
-                            logging.debug(f"Exception details: {traceback.format_exc()}")
-                            # Mark the VTT as failed
-                            mark_vtt_as_downloaded(JW_DB_PATH, identifier, track, formatCode, vtt_file_url, 'failed')
-                            break  # Exit the retry loop
-
-                else:
-                    logging.warning(f"No subtitles found for {identifier} track {track} format {formatCode}")
-                    # Optionally, record this as 'no_subtitles' in the database
-                    mark_vtt_as_downloaded(JW_DB_PATH, identifier, track, formatCode, None, 'no_subtitles')
+# Fetch one VTT file, retrying transient failures with exponential backoff
+async def download_vtt(session, identifier, track, formatCode, vtt_file_url, max_retries=3):
+    for attempt in range(1, max_retries + 1):
+        try:
+            async with session.get(vtt_file_url) as vtt_response:
+                vtt_response.raise_for_status()
+                content = await vtt_response.read()
+
+            # Extract the filename from the URL
+            parsed_url = urlparse(vtt_file_url)
+            filename = os.path.basename(parsed_url.path)
+            filename = unquote(filename)  # Decode URL-encoded characters
+
+            # Save VTT file with the original filename
+            vtt_filename = os.path.join(JW_OUTPUT_PATH, filename)
+
+            with open(vtt_filename, 'wb') as vtt_output:
+                vtt_output.write(content)
+
+            logging.info(f"Downloaded: {vtt_filename}")
+
+            # Mark the VTT as successfully downloaded
+            mark_vtt_as_downloaded(identifier, track, formatCode, vtt_file_url, 'success')
+            return
+
+        except aiohttp.ClientError as e:
+            logging.warning(f"Attempt {attempt} failed for {identifier} track {track}: {e}")
+            logging.debug(f"Exception details: {traceback.format_exc()}")
+            if attempt < max_retries:
+                # Full jitter: spread retries out so concurrent workers do
+                # not hammer the CDN in lockstep after a shared failure
+                wait_time = random.uniform(1, 2 ** attempt)
+                logging.info(f"Retrying in {wait_time:.1f} seconds...")
+                await asyncio.sleep(wait_time)
             else:
-                logging.error(f"No media links available for {identifier} track {track} format {formatCode}")
-                logging.debug(f"Response from get_pub_media_links for {identifier} track {track} format {formatCode}: {media_links}")
-                # Record this as failed attempt
-                mark_vtt_as_downloaded(JW_DB_PATH, identifier, track, formatCode, None, 'failed')
+                logging.error(f"All {max_retries} attempts failed for {identifier} track {track}")
+                # Mark the VTT as failed
+                mark_vtt_as_downloaded(identifier, track, formatCode, vtt_file_url, 'failed')
+        except Exception as e:
+            logging.error(f"Unexpected error for {identifier} track {track}: {e}")
+            logging.debug(f"Exception details: {traceback.format_exc()}")
+            # Mark the VTT as failed
+            mark_vtt_as_downloaded(identifier, track, formatCode, vtt_file_url, 'failed')
+            return
+
+async def process_media_item(session, status_cache, identifier, track, formatCode, key_parts):
+    status = status_cache.get((identifier, track, formatCode))
+
+    if status == 'success':
+        logging.info(f"Already successfully processed {identifier} track {track} format {formatCode}, skipping.")
+        return
+    elif status == 'failed':
+        logging.info(f"Already attempted but failed {identifier} track {track} format {formatCode}, skipping.")
+        return
+
+    # Proceed to attempt to get media links and download
+    media_links = await get_pub_media_links(session, identifier, track, formatCode, key_parts)
+
+    if media_links and "files" in media_links:
+        vtt_file_url = None
+
+        # We no longer skip items based on title
+        formats = media_links["files"].get(JW_LANG, {})
+
+        # The API flags each file as subtitled or not; skip the per-file
+        # scan entirely for the common no-subtitles case
+        if not any(file.get('subtitled')
+                   for file_format_entries in formats.values()
+                   for file in file_format_entries):
+            logging.warning(f"No subtitles found for {identifier} track {track} format {formatCode}")
+            mark_vtt_as_downloaded(identifier, track, formatCode, None, 'no_subtitles')
+            return
+
+        found_vtt = False
+        # Iterate over available formats and files
+        for file_format_entries in formats.values():
+            for file in file_format_entries:
+                # Check if 'subtitles' are available
+                subtitles = file.get('subtitles')
+                if subtitles and 'url' in subtitles:
+                    vtt_file_url = subtitles['url']
+                    found_vtt = True
+                    break
+            if found_vtt:
+                break
+
+        if vtt_file_url:
+            await download_vtt(session, identifier, track, formatCode, vtt_file_url)
+        else:
+            logging.warning(f"No subtitles found for {identifier} track {track} format {formatCode}")
+            # Optionally, record this as 'no_subtitles' in the database
+            mark_vtt_as_downloaded(identifier, track, formatCode, None, 'no_subtitles')
+    else:
+        logging.error(f"No media links available for {identifier} track {track} format {formatCode}")
+        logging.debug(f"Response from get_pub_media_links for {identifier} track {track} format {formatCode}: {media_links}")
+        # Record this as failed attempt
+        mark_vtt_as_downloaded(identifier, track, formatCode, None, 'failed')
+
+# Pull media items off the queue until cancelled
+async def vtt_worker(session, queue, status_cache):
+    while True:
+        identifier, track, formatCode, key_parts = await queue.get()
+        try:
+            await process_media_item(session, status_cache, identifier, track, formatCode, key_parts)
+        except Exception as e:
+            logging.error(f"Unexpected error for {identifier} track {track}: {e}")
+            logging.debug(f"Exception details: {traceback.format_exc()}")
+        finally:
+            queue.task_done()
+
+async def download_vtt_files(media_info):
+    status_cache = load_vtt_status()
+    total_items = 0
+
+    # One TCP pool for the whole run; the worker count bounds concurrency
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=16)
+    async with aiohttp.ClientSession(connector=connector,
+                                     headers={'Accept-Encoding': 'gzip, br'}) as session:
+        queue = asyncio.Queue(maxsize=CONCURRENCY * 2)
+        workers = [asyncio.create_task(vtt_worker(session, queue, status_cache))
+                   for _ in range(CONCURRENCY)]
+
+        # The catalog iterator does blocking network reads; step it in a
+        # thread so the download workers keep running meanwhile
+        iterator = iter(media_info)
+        while True:
+            item = await asyncio.to_thread(next, iterator, None)
+            if item is None:
+                break
+            total_items += 1
+            await queue.put(item)
+
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    logging.info(f"Total media items processed: {total_items}")
 
 if __name__ == "__main__":
-    setup_database(JW_DB_PATH)
+    DB = setup_database(JW_DB_PATH)
     catalog_url = f"https://app.jw-cdn.org/catalogs/media/{JW_LANG}.json.gz"
-    json_path = download_extract_json(catalog_url, JW_OUTPUT_PATH)
-
-    if json_path:
-        media_info = extract_media_info(json_path)
-        logging.info(f"Total media items to process: {len(media_info)}")
-        download_vtt_files(media_info)
+    asyncio.run(download_vtt_files(extract_media_info(iter_catalog_lines(catalog_url))))
 
+    # Flush any marks from the last partial batch and refresh planner stats
+    flush_marks()
+    DB.execute("ANALYZE")
+    DB.commit()
+    DB.close()
     logging.info("Finished processing all media items.")
\ No newline at end of file
@@ -1,13 +1,15 @@
-import requests
-import gzip
-import shutil
+import aiofiles
+import aiohttp
+import asyncio
 import sqlite3
 import os
-import json
+import orjson
 import logging
-import re
+import random
 import traceback
-import time
+from email.message import Message
+
+from jw_common import make_session, tune_connection, fetch_catalog_conn
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,18 +19,21 @@ JW_OUTPUT_PATH = os.environ.get('JW_OUTPUT_PATH', '/jworg/jwpubs/')
 JW_DB_PATH = os.environ.get('JW_DB_PATH', '/jworg/jwpubs/jw_pubs.db')
 MEPSUNIT_DB_PATH = os.environ.get('MEPSUNIT_DB_PATH', '/app/db/mepsunit.db')  # Path to mepsunit.db
 
+# Number of concurrent publication downloads; the work is pure network I/O
+PUB_CONCURRENCY = 16
+
+# One pooled session for the (synchronous) manifest and catalog fetches;
+# transient errors retry with backoff
+SESSION = make_session(pool_maxsize=32, backoff_factor=2)
+
 # Create output directory if it doesn't exist
-if not os.path.exists(JW_OUTPUT_PATH):
-    os.makedirs(JW_OUTPUT_PATH)
+os.makedirs(JW_OUTPUT_PATH, exist_ok=True)
 
 def setup_state_database(db_path):
-    if not os.path.exists(os.path.dirname(db_path)):
-        os.makedirs(os.path.dirname(db_path))
-    if not os.path.exists(db_path):
-        logging.info(f"Database does not exist at {db_path}. Creating new database.")
-        open(db_path, 'w').close()
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
     try:
         conn = sqlite3.connect(db_path)
+        tune_connection(conn)
         cursor = conn.cursor()
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS PublicationState (
@@ -39,56 +44,14 @@ def setup_state_database(db_path):
             PRIMARY KEY (IssueTagNumber, Symbol)
         )
         ''')
+        # The preload filters on State, so give it an index as the table grows
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pubstate ON PublicationState(State)')
         conn.commit()
         return conn
     except Exception as e:
         logging.error(f"Error setting up database: {e}")
         return None
 
-def fetch_catalog_db():
-    try:
-        # Step 1: Get the manifest ID and download the catalog.db.gz
-        logging.info("Fetching manifest ID.")
-        manifest_url = "https://app.jw-cdn.org/catalogs/publications/v4/manifest.json"
-        response = requests.get(manifest_url)
-        response.raise_for_status()
-        manifest_id = response.json().get('current')
-        if not manifest_id:
-            logging.error("Failed to fetch manifest ID.")
-            raise ValueError("Manifest ID is missing")
-
-        catalog_url = f"https://app.jw-cdn.org/catalogs/publications/v4/{manifest_id}/catalog.db.gz"
-        logging.info(f"Downloading catalog from {catalog_url}.")
-        response = requests.get(catalog_url, stream=True)
-        response.raise_for_status()
-
-        # Ensure the output directory exists
-        if not os.path.exists(JW_OUTPUT_PATH):
-            os.makedirs(JW_OUTPUT_PATH)
-
-        # Define paths for .gz and .db files in the output directory
-        gz_path = os.path.join(JW_OUTPUT_PATH, "catalog.db.gz")
-        db_path = os.path.join(JW_OUTPUT_PATH, "catalog.db")
-
-        with open(gz_path, "wb") as catalog_file:
-            catalog_file.write(response.content)
-
-        # Step 2: Extract catalog.db from catalog.db.gz
-        logging.info("Extracting catalog.db from catalog.db.gz.")
-        with gzip.open(gz_path, "rb") as f_in:
-            with open(db_path, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-
-        # Step 3: Delete the .gz file after uncompressing
-        logging.info("Deleting catalog.db.gz after extraction.")
-        os.remove(gz_path)
-
-        return db_path
-    except Exception as e:
-        logging.error(f"Error in fetching or extracting catalog.db: {e}")
-        logging.debug(f"Exception details: {traceback.format_exc()}")
-        return None
-
 def get_meps_language_id(jw_lang, mepsunit_db_path):
     try:
         # Open the mepsunit.db database
@@ -124,13 +87,132 @@ def get_publications(conn_catalog, meps_language_id):
         logging.debug(f"Exception details: {traceback.format_exc()}")
         return []
 
-def download_jwpubs():
+def mark_publication_state(conn_state, issue_tag_number, symbol, keysymbol, state):
+    try:
+        conn_state.execute('''
+        INSERT OR REPLACE INTO PublicationState (IssueTagNumber, Symbol, KeySymbol, State)
+        VALUES (?, ?, ?, ?)
+        ''', (issue_tag_number, symbol, keysymbol, state))
+        conn_state.commit()
+    except Exception as e:
+        logging.error(f"Error updating state for Symbol {symbol}, IssueTagNumber {issue_tag_number}: {e}")
+
+async def process_publication(session, conn_state, issue_tag_number, symbol, keysymbol):
+    logging.info(f"Processing publication: Symbol={symbol}, IssueTagNumber={issue_tag_number}, KeySymbol={keysymbol}")
+
+    # Determine the URL for the publication
+    if issue_tag_number != 0:
+        url = f"https://app.jw-cdn.org/apis/pub-media/GETPUBMEDIALINKS?langwritten={JW_LANG}&pub={keysymbol}&issue={issue_tag_number}&fileformat=jwpub"
+    else:
+        url = f"https://app.jw-cdn.org/apis/pub-media/GETPUBMEDIALINKS?langwritten={JW_LANG}&pub={symbol}&fileformat=jwpub"
+
+    max_retries = 3
+    retry_count = 0
+    wait_time = 2
+
+    while retry_count < max_retries:
+        try:
+            logging.info(f"Fetching media links from {url}")
+            async with session.get(url) as response:
+                response.raise_for_status()
+                # orjson parses the raw bytes directly, skipping aiohttp's
+                # json machinery and the intermediate str decode
+                metadata = orjson.loads(await response.read())
+
+            # Extract download URL
+            files = metadata.get('files', {}).get(JW_LANG, {}).get('JWPUB', [])
+            if not files:
+                logging.warning(f"No JWPUB files found for Symbol {symbol}, IssueTagNumber {issue_tag_number}")
+                mark_publication_state(conn_state, issue_tag_number, symbol, keysymbol, "no_jwpub")
+                return
+
+            download_url = files[0]['file']['url']
+
+            # Check the remote size first so finished files are skipped
+            # and partial ones resumed instead of re-downloaded from byte 0
+            async with session.head(download_url, allow_redirects=True) as head_response:
+                head_response.raise_for_status()
+                remote_size = int(head_response.headers.get('Content-Length', 0) or 0)
+                content_disposition = head_response.headers.get('Content-Disposition', '')
+
+            # Extract filename from headers or construct one; Message handles
+            # quoting and RFC 5987 filename*= encoding, unlike the old regex
+            filename = None
+            if content_disposition:
+                message = Message()
+                message['content-disposition'] = content_disposition
+                filename = message.get_filename()
+            if filename is None:
+                filename = f"{symbol}_{issue_tag_number}.jwpub"
+
+            output_file_path = os.path.join(JW_OUTPUT_PATH, filename)
+            local_size = os.path.getsize(output_file_path) if os.path.exists(output_file_path) else 0
+
+            if remote_size and local_size == remote_size:
+                logging.info(f"File {output_file_path} already complete, skipping download.")
+            else:
+                headers = {}
+                file_mode = "wb"
+                if remote_size and 0 < local_size < remote_size:
+                    # Resume from where the previous run stopped
+                    logging.info(f"Resuming download of {output_file_path} from byte {local_size}.")
+                    headers['Range'] = f"bytes={local_size}-"
+                    file_mode = "ab"
+
+                logging.info(f"Downloading file from {download_url}.")
+                async with session.get(download_url, headers=headers) as file_response:
+                    file_response.raise_for_status()
+                    if headers and file_response.status != 206:
+                        # Server ignored the Range request; rewrite from scratch
+                        file_mode = "wb"
+
+                    async with aiofiles.open(output_file_path, file_mode) as output_file:
+                        # 1 MiB chunks: far fewer Python-level iterations on big files
+                        async for chunk in file_response.content.iter_chunked(1 << 20):
+                            await output_file.write(chunk)
+                logging.info(f"Downloaded file to {output_file_path}.")
+
+            # Update state as processed in the state database
+            mark_publication_state(conn_state, issue_tag_number, symbol, keysymbol, "processed")
+            return
+        except aiohttp.ClientError as e:
+            retry_count += 1
+            logging.warning(f"Attempt {retry_count} failed for Symbol {symbol}, IssueTagNumber {issue_tag_number}: {e}")
+            logging.debug(f"Exception details: {traceback.format_exc()}")
+            if retry_count < max_retries:
+                # Full jitter: spread retries out so concurrent workers do
+                # not hammer the CDN in lockstep after a shared failure
+                delay = random.uniform(1, wait_time)
+                logging.info(f"Retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+                wait_time *= 2  # Exponential backoff
+            else:
+                logging.error(f"All {max_retries} attempts failed for Symbol {symbol}, IssueTagNumber {issue_tag_number}")
+                mark_publication_state(conn_state, issue_tag_number, symbol, keysymbol, "failed")
+        except Exception as e:
+            logging.error(f"Unexpected error for Symbol {symbol}, IssueTagNumber {issue_tag_number}: {e}")
+            logging.debug(f"Exception details: {traceback.format_exc()}")
+            mark_publication_state(conn_state, issue_tag_number, symbol, keysymbol, "failed")
+            return
+
+# Pull publications off the queue until cancelled
+async def pub_worker(session, conn_state, queue):
+    while True:
+        issue_tag_number, symbol, keysymbol = await queue.get()
+        try:
+            await process_publication(session, conn_state, issue_tag_number, symbol, keysymbol)
+        except Exception as e:
+            logging.error(f"Error processing publication Symbol {symbol}, IssueTagNumber {issue_tag_number}: {e}")
+            logging.debug(f"Exception details: {traceback.format_exc()}")
+        finally:
+            queue.task_done()
+
+async def download_jwpubs():
     # Setup databases
     conn_state = setup_state_database(JW_DB_PATH)
     if conn_state is None:
         logging.error("State database setup failed. Exiting.")
         return
-    cursor_state = conn_state.cursor()
 
     # Get MepsLanguageId corresponding to JW_LANG
     meps_language_id = get_meps_language_id(JW_LANG, MEPSUNIT_DB_PATH)
@@ -138,122 +220,54 @@ def download_jwpubs():
         logging.error("Failed to retrieve MepsLanguageId. Exiting.")
         return
 
-    db_path = fetch_catalog_db()
-    if db_path is None:
+    conn_catalog = fetch_catalog_conn(SESSION, JW_OUTPUT_PATH)
+    if conn_catalog is None:
         logging.error("Failed to fetch the catalog database. Exiting.")
         return
 
-    try:
-        # Connect to the catalog SQLite database using the full path
-        logging.info("Connecting to the catalog SQLite database.")
-        conn_catalog = sqlite3.connect(db_path)
-    except Exception as e:
-        logging.error(f"Error connecting to catalog database: {e}")
-        return
-
     # Get the list of publications
     publications = get_publications(conn_catalog, meps_language_id)
-
-    for idx, (issue_tag_number, symbol, keysymbol) in enumerate(publications, 1):
-        logging.info(f"Processing publication {idx}/{len(publications)}: Symbol={symbol}, IssueTagNumber={issue_tag_number}, KeySymbol={keysymbol}")
-
-        try:
-            cursor_state.execute("SELECT State FROM PublicationState WHERE IssueTagNumber=? AND Symbol=?", (issue_tag_number, symbol))
-            state_row = cursor_state.fetchone()
-            if state_row and state_row[0] == "processed":
-                logging.info(f"Skipping already processed entry: Symbol {symbol}, IssueTagNumber {issue_tag_number}")
-                continue
-
-            # Determine the URL for the publication
-            if issue_tag_number != 0:
-                url = f"https://app.jw-cdn.org/apis/pub-media/GETPUBMEDIALINKS?langwritten={JW_LANG}&pub={keysymbol}&issue={issue_tag_number}&fileformat=jwpub"
-            else:
-                url = f"https://app.jw-cdn.org/apis/pub-media/GETPUBMEDIALINKS?langwritten={JW_LANG}&pub={symbol}&fileformat=jwpub"
-
-            download_successful = False
-            max_retries = 3
-            retry_count = 0
-            wait_time = 2
-
-            while retry_count < max_retries and not download_successful:
-                try:
-                    logging.info(f"Fetching media links from {url}")
-                    response = requests.get(url)
-                    response.raise_for_status()
-                    metadata = response.json()
-
-                    # Extract download URL
-                    files = metadata.get('files', {}).get(JW_LANG, {}).get('JWPUB', [])
-                    if not files:
-                        logging.warning(f"No JWPUB files found for Symbol {symbol}, IssueTagNumber {issue_tag_number}")
-                        cursor_state.execute('''
-                        INSERT OR REPLACE INTO PublicationState (IssueTagNumber, Symbol, KeySymbol, State)
-                        VALUES (?, ?, ?, ?)
-                        ''', (issue_tag_number, symbol, keysymbol, "no_jwpub"))
-                        conn_state.commit()
-                        break  # Exit the retry loop
-
-                    download_url = files[0]['file']['url']
-
-                    # Download the file to JW_OUTPUT_PATH
-                    logging.info(f"Downloading file from {download_url}.")
-                    file_response = requests.get(download_url, stream=True)
-                    file_response.raise_for_status()
-
-                    # Extract filename from headers or construct one
-                    filename = None
-                    content_disposition = file_response.headers.get('Content-Disposition', '')
-                    if 'filename=' in content_disposition:
-                        filename_match = re.search(r'filename="?([^"]+)"?', content_disposition)
-                        if filename_match:
-                            filename = filename_match.group(1)
-                    if filename is None:
-                        filename = f"{symbol}_{issue_tag_number}.jwpub"
-
-                    output_file_path = os.path.join(JW_OUTPUT_PATH, filename)
-                    with open(output_file_path, "wb") as output_file:
-                        shutil.copyfileobj(file_response.raw, output_file)
-                    logging.info(f"Downloaded file to {output_file_path}.")
-
-                    # Update state as processed in the state database
-                    cursor_state.execute('''
-                    INSERT OR REPLACE INTO PublicationState (IssueTagNumber, Symbol, KeySymbol, State)
-                    VALUES (?, ?, ?, ?)
-                    ''', (issue_tag_number, symbol, keysymbol, "processed"))
-                    conn_state.commit()
-
-                    download_successful = True
-                except requests.exceptions.RequestException as e:
-                    retry_count += 1
-                    logging.warning(f"Attempt {retry_count} failed for Symbol {symbol}, IssueTagNumber {issue_tag_number}: {e}")
-                    logging.debug(f"Exception details: {traceback.format_exc()}")
-                    if retry_count < max_retries:
-                        logging.info(f"Retrying in {wait_time} seconds...")
-                        time.sleep(wait_time)
-                        wait_time *= 2  # Exponential backoff
-                    else:
-                        logging.error(f"All {max_retries} attempts failed for Symbol {symbol}, IssueTagNumber {issue_tag_number}")
-                        cursor_state.execute('''
-                        INSERT OR REPLACE INTO PublicationState (IssueTagNumber, Symbol, KeySymbol, State)
-                        VALUES (?, ?, ?, ?)
-                        ''', (issue_tag_number, symbol, keysymbol, "failed"))
-                        conn_state.commit()
-                except Exception as e:
-                    logging.error(f"Unexpected error for Symbol {symbol}, IssueTagNumber {issue_tag_number}: {e}")
-                    logging.debug(f"Exception details: {traceback.format_exc()}")
-                    cursor_state.execute('''
-                    INSERT OR REPLACE INTO PublicationState (IssueTagNumber, Symbol, KeySymbol, State)
-                    VALUES (?, ?, ?, ?)
-                    ''', (issue_tag_number, symbol, keysymbol, "failed"))
-                    conn_state.commit()
-                    break  # Exit the retry loop
-        except Exception as e:
-            logging.error(f"Error processing publication Symbol {symbol}, IssueTagNumber {issue_tag_number}: {e}")
-            logging.debug(f"Exception details: {traceback.format_exc()}")
-            continue  # Proceed to next publication
-
-    # Close the database connections
     conn_catalog.close()
+
+    # Resolve already-processed entries with one query instead of one SELECT per row
+    try:
+        processed = {(row[0], row[1]) for row in conn_state.execute(
+            "SELECT IssueTagNumber, Symbol FROM PublicationState WHERE State='processed'")}
+    except Exception as e:
+        logging.error(f"Error loading processed publications: {e}")
+        processed = set()
+
+    # SELECT DISTINCT dedupes on all three columns, but the request URL only
+    # uses (keysymbol, issue) or (symbol), so rows differing in the unused
+    # column would fetch the same publication twice
+    seen_urls = set()
+    to_process = []
+    for issue_tag_number, symbol, keysymbol in publications:
+        if (issue_tag_number, symbol) in processed:
+            continue
+        url_key = (issue_tag_number, keysymbol) if issue_tag_number != 0 else (0, symbol)
+        if url_key in seen_urls:
+            continue
+        seen_urls.add(url_key)
+        to_process.append((issue_tag_number, symbol, keysymbol))
+    logging.info(f"Publications to process: {len(to_process)} of {len(publications)}")
+
+    connector = aiohttp.TCPConnector(limit=PUB_CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector,
+                                     headers={'Accept-Encoding': 'gzip, br'}) as session:
+        queue = asyncio.Queue()
+        workers = [asyncio.create_task(pub_worker(session, conn_state, queue))
+                   for _ in range(PUB_CONCURRENCY)]
+
+        for publication in to_process:
+            await queue.put(publication)
+
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    # Close the database connection
     conn_state.close()
 
     # Cleanup complete
@@ -263,7 +277,7 @@ def download_jwpubs():
 
 if __name__ == "__main__":
     try:
-        download_jwpubs()
+        asyncio.run(download_jwpubs())
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         logging.debug(f"Exception details: {traceback.format_exc()}")
\ No newline at end of file